@@ -2,30 +2,60 @@
 Helpers to run alr in the testsuite.
 """
 
+import contextlib
+import functools
 import os
 import os.path
 import platform
 import pexpect
 import re
+import stat
+import subprocess
 import sys
 
-from e3.fs import mkdir
-from e3.os.process import Run, quote_arg
+from e3.os.process import quote_arg
 from e3.testsuite.driver.classic import ProcessResult
-from shutil import copytree
+from shutil import copy2, copystat, copytree
 
 TESTSUITE_ROOT = os.path.dirname(os.path.dirname(
     os.path.abspath(__file__)))
 
+_FIXTURES_ROOT = os.path.join(TESTSUITE_ROOT, 'fixtures')
+_CRATES_DIR = os.path.join(_FIXTURES_ROOT, 'crates')
+
+# Linux ioctl to clone a file, from linux/fs.h
+_FICLONE = 0x40049409
+
+# Matches the `alr version` line reporting an undetected distribution
+_DISTRO_UNKNOWN = re.compile('distribution:[^\n]*DISTRIBUTION_UNKNOWN')
+
+# Captures the value in the `alr version` line reporting the index branch
+_INDEX_BRANCH = re.compile('^community index[^:\n]*:([^:\n]*)', re.M)
+
+# Any of the characters separating a crate name from its version set
+_DEP_SEPARATOR = re.compile('[/=^~<>*]')
+
+# Environment variable with the location of the default settings for tests, as
+# prepared by `prepare_settings_template`.
+_SETTINGS_TEMPLATE = 'ALR_TESTSUITE_SETTINGS_TEMPLATE'
+
+# Whether manual manifest editions are awaiting an update, or None when not
+# within a `deferred_updates` block. Only test scripts use these helpers, each
+# in its own single-threaded interpreter, so module state suffices.
+_pending_update = None
+
+# Whether any deferred edition asked for its update to be forced
+_pending_force = False
+
 
 class CalledProcessError(Exception):
     pass
 
 
+@functools.lru_cache(maxsize=1)
 def distro_is_known():
     p = run_alr('version')
-    return not re.match('.*distribution:.*DISTRIBUTION_UNKNOWN.*',
-                        p.out, flags=re.S)
+    return _DISTRO_UNKNOWN.search(p.out) is None
 
 
 def prepare_env(settings_dir, env):
@@ -42,8 +72,34 @@ def prepare_env(settings_dir, env):
     env["GIT_CONFIG_SYSTEM"] = "/dev/null"
 
     settings_dir = os.path.abspath(settings_dir)
-    mkdir(settings_dir)
     env['ALIRE_SETTINGS_DIR'] = settings_dir
+
+    # Start from the default settings prepared once for the whole testsuite, if
+    # available. Otherwise, apply them here.
+    template = env.pop(_SETTINGS_TEMPLATE, None)
+    if template is not None:
+        copytree(template, settings_dir, dirs_exist_ok=True)
+    else:
+        os.makedirs(settings_dir, exist_ok=True)
+        _apply_default_settings(settings_dir, env)
+
+
+def prepare_settings_template(settings_dir, env):
+    """
+    Create in `settings_dir` the default settings that `prepare_env` applies,
+    and record its location in `env` so `prepare_env` copies them from there
+    instead of running alr to set each of them anew for every test.
+    """
+    settings_dir = os.path.abspath(settings_dir)
+    os.makedirs(settings_dir, exist_ok=True)
+    _apply_default_settings(settings_dir, env)
+    env[_SETTINGS_TEMPLATE] = settings_dir
+
+
+def _apply_default_settings(settings_dir, env):
+    """
+    Configure in `settings_dir` the alr settings that tests expect by default.
+    """
     #  We pass settings location explicitly in the following calls since env is
     #  not yet applied (it's just a dict to be passed later to subprocess)
 
@@ -110,25 +166,38 @@ def run_alr(*args, **kwargs):
     force = kwargs.pop('force', False)
     quiet = kwargs.pop('quiet', True)
     if kwargs:
-        first_unknown_kwarg = sorted(kwargs)[0]
-        raise ValueError('Invalid argument: {}'.format(first_unknown_kwarg))
-
-    argv = [os.environ['ALR_PATH']]
-    argv.insert(1, '-n')  # always non-interactive
-    if debug:
-        argv.insert(1, '-d')
-    if force:
-        argv.insert(1, '-f')
-    if quiet:
-        argv.insert(1, '-q')
-    argv.extend(args)
-    p = Run(argv)
-    _report_unexpected_exit_status(p.status, complain_on_error, argv, p.out)
+        raise ValueError('Invalid argument: {}'.format(next(iter(kwargs))))
+
+    argv = [os.environ['ALR_PATH'],
+            *(('-q',) if quiet else ()),
+            *(('-f',) if force else ()),
+            *(('-d',) if debug else ()),
+            '-n',  # always non-interactive
+            *args]
+
+    # Settings may affect the output of `alr version`, which is memoized
+    if "settings" in args:
+        _version_cache_clear()
+
+    # Run directly through subprocess, without e3's Run wrapper, as this is
+    # called many times per test. Not closing inherited file descriptors spares
+    # scanning them on every spawn.
+    #
+    # A fresh process per command is required: alr elaborates its settings,
+    # indexes and workspace once per run, honors -C by changing its working
+    # directory, and ends commands through Alire.OS_Lib.Bailout, so a single
+    # long-lived alr could not serve several commands in a row.
+    p = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                       close_fds=False)
+    out = p.stdout.decode(errors='replace')
+    _report_unexpected_exit_status(p.returncode, complain_on_error, argv, out)
 
     # Convert CRLF line endings (Windows-style) to LF (Unix-style). This
     # canonicalization is necessary to make output comparison work on all
-    # platforms.
-    return ProcessResult(p.status, p.out.replace('\r\n', '\n'))
+    # platforms. Skip the copy when there is nothing to replace.
+    if '\r' in out:
+        out = out.replace('\r\n', '\n')
+    return ProcessResult(p.returncode, out)
 
 
 def run_alr_interactive(args: list[str], output: list[str], input: list[str],
@@ -211,7 +280,51 @@ def fixtures_path(*args):
     """
     Return a path under the testsuite `fixtures` directory.
     """
-    return os.path.join(TESTSUITE_ROOT, 'fixtures', *args)
+    return os.path.join(_FIXTURES_ROOT, *args) if args else _FIXTURES_ROOT
+
+
+def _link_or_copy(src, dst):
+    """
+    Hard link src as dst, or copy it if the filesystem does not allow it (e.g.
+    when crossing devices). Files without write permission for their owner are
+    always copied, as the driver may make them writable later on, which would
+    affect the original too. The mode bits are checked rather than using
+    os.access, which always grants writing to root.
+    """
+    if os.stat(src).st_mode & stat.S_IWUSR:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    _clone_or_copy(src, dst)
+
+
+def _clone_or_copy(src, dst):
+    """
+    Copy src as dst, sharing its data blocks instead on Linux filesystems that
+    support copy-on-write clones (e.g. Btrfs, XFS). Metadata is copied as done
+    by shutil.copy2, which is used otherwise.
+    """
+    if platform.system() == "Linux":
+        import fcntl
+        try:
+            with open(src, 'rb') as source, open(dst, 'wb') as target:
+                fcntl.ioctl(target.fileno(), _FICLONE, source.fileno())
+            copystat(src, dst)
+            return
+        except OSError:
+            pass
+    copy2(src, dst)
+
+
+def _fast_copytree(src, dst):
+    """
+    Replicate the src tree as dst, hard linking files instead of copying their
+    contents whenever possible. Files in dst must not be modified in place, as
+    that would modify the originals too.
+    """
+    copytree(src, dst, copy_function=_link_or_copy)
 
 
 def prepare_indexes(config_dir, working_dir, index_descriptions):
@@ -234,7 +347,11 @@ def prepare_indexes(config_dir, working_dir, index_descriptions):
         * "priority" (int): Priority for this index. 1 by default.
     """
     indexes_dir = os.path.join(config_dir, 'indexes')
-    mkdir(indexes_dir)
+    os.makedirs(indexes_dir, exist_ok=True)
+
+    # All indexes asking for the fixture crates get them at the same location,
+    # so replicate them only once rather than failing on the existing copy.
+    crates_copied = False
 
     for name, desc in index_descriptions.items():
         # Extract individual fields in `desc`
@@ -269,34 +386,37 @@ def prepare_indexes(config_dir, working_dir, index_descriptions):
                      if in_fixtures else
                      files_dir)
 
-        if copy_crates_src:
-            crates_dir = fixtures_path('crates')
-            copytree(crates_dir, os.path.join(working_dir, 'crates'))
+        if copy_crates_src and not crates_copied:
+            _fast_copytree(_CRATES_DIR, os.path.join(working_dir, 'crates'))
+            crates_copied = True
             # Crates are adjacent to the index but outside it (otherwise the
-            # index loader detects spurious files).
+            # index loader detects spurious files). Their files are shared
+            # with the fixtures, which is fine as alr/gprbuild only create new
+            # files there (e.g. when building through a path pin).
 
         # Finally create the index description in the config directory
         index_dir = os.path.join(indexes_dir, name)
-        mkdir(index_dir)
-        with open(os.path.join(index_dir, 'index.toml'), 'w') as f:
-            f.write("""
-name = '{}'
-priority = {}
-url = '{}'
-            """.format(name, priority, os.path.join(working_dir, files_dir)))
+        os.makedirs(index_dir, exist_ok=True)
+        url = os.path.join(working_dir, files_dir)
+        with open(os.path.join(index_dir, 'index.toml'), 'wb') as f:
+            f.write(f"name = '{name}'\n"
+                    f"priority = {priority}\n"
+                    f"url = '{url}'\n".encode())
 
 
+@functools.lru_cache(maxsize=1)
 def index_branch():
     """
     Identify the expected index branch from `alr version`
     """
     p = run_alr("version", quiet=False)
-    for line in p.out.splitlines():
-        if line.startswith("community index"):
-            return line.split(':')[1].strip()
-    raise Exception("Unexpected alr output, cannot find index version")
+    match = _INDEX_BRANCH.search(p.out)
+    if match is None:
+        raise Exception("Unexpected alr output, cannot find index version")
+    return match.group(1).strip()
 
 
+@functools.lru_cache(maxsize=1)
 def index_version():
     """
     Identify the expected index version from `alr version`
@@ -304,6 +424,16 @@ def index_version():
     return index_branch().split('-')[1]
 
 
+def _version_cache_clear():
+    """
+    Forget the results of `alr version` queries, which are memoized as they
+    only change when settings are modified.
+    """
+    distro_is_known.cache_clear()
+    index_branch.cache_clear()
+    index_version.cache_clear()
+
+
 def init_local_crate(name="xxx", binary=True, enter=True, update=True,
                      with_maintainer_login=False):
     """
@@ -350,8 +480,61 @@ def alr_touch_manifest():
     Make the lockfile older than the manifest, to ensure editions to the
     manifest are detected.
     """
-    if os.path.exists(alr_lockfile()):
-        os.utime(alr_lockfile(), (0, 0))
+    # A single stat tells both whether the lockfile exists and whether it is
+    # already as old as it can be (e.g. after several editions in a row).
+    try:
+        if os.stat(alr_lockfile()).st_mtime != 0:
+            os.utime(alr_lockfile(), (0, 0))
+    except FileNotFoundError:
+        pass
+
+
+@contextlib.contextmanager
+def deferred_updates():
+    """
+    Within this context, manual manifest editions by alr_with, alr_pin and
+    alr_unpin do not run `alr` to update the solution after each change.
+    Instead, a single `alr pin` is run on exiting the context, if needed.
+    The manifest itself is still edited on disk as each change is made. The
+    final update is forced if any of the deferred editions asked for it.
+
+    As no update is run for them, alr_with and alr_pin return None instead of
+    the result of `alr` within this context.
+
+    Intended for single-threaded test scripts.
+    """
+    global _pending_update, _pending_force
+    if _pending_update is not None:
+        # Nested use, the outermost context will do the update
+        yield
+        return
+
+    _pending_update = False
+    _pending_force = False
+    try:
+        yield
+        update, force = _pending_update, _pending_force
+    finally:
+        _pending_update = None
+        _pending_force = False
+
+    if update:
+        # so the changes in the manifest are applied
+        run_alr("pin", force=force)
+
+
+def _manual_update(update, force=False):
+    """
+    Say whether a manual manifest edition must be followed right away by an
+    update, recording it for later instead when within `deferred_updates`,
+    along with whether the update must be forced.
+    """
+    global _pending_update, _pending_force
+    if _pending_update is None:
+        return update
+    _pending_update = _pending_update or update
+    _pending_force = _pending_force or (update and force)
+    return False
 
 
 def delete_array_entry_from_manifest(array, crate,
@@ -360,27 +543,31 @@ def delete_array_entry_from_manifest(array, crate,
     Manual deletion of dependencies/pins. As we emit the additions too, this is
     simpler than the actual code in alr.
     """
-    with open(alr_manifest(), "rt") as manifest:
-            found = False
-            lines = manifest.readlines()
-            orig = lines
-            for i in range(1, len(lines)):
-                if lines[i].startswith(f"{crate} =") \
-                  and lines[i-1] == f"[[{array}]]\n":
-                    lines.pop(i)
-                    lines.pop(i-1)
-                    found = True
-                    break
+    # Work on bytes so the rest of the manifest is written back unchanged,
+    # whatever its encoding and line endings.
+    header = f"[[{array}]]".encode()
+    prefix = f"{crate} =".encode()
+
+    with open(alr_manifest(), "rb") as manifest:
+        lines = manifest.read().splitlines(keepends=True)
+
+    found = False
+    for i in range(1, len(lines)):
+        if lines[i - 1].rstrip(b"\r\n") == header \
+           and lines[i].startswith(prefix):
+            del lines[i - 1:i + 1]
+            found = True
+            break
 
     # Write the new manifest
     if found:
-        with open(alr_manifest(), "wt") as manifest:
-            manifest.writelines(lines)
-        if update:
+        with open(alr_manifest(), "wb") as manifest:
+            manifest.write(b"".join(lines))
+        if _manual_update(update):
             run_alr("pin")  # Ensure changes don't affect next command output
     elif fail_if_missing:
-            raise RuntimeError
-            (f"Could not remove crate {crate} in lines:\n" + str(orig))
+        raise RuntimeError(f"Could not remove crate {crate} in manifest:\n"
+                           + b"".join(lines).decode(errors="replace"))
 
     # Make the lockfile "older" (otherwise timestamp is identical)
     alr_touch_manifest()
@@ -433,13 +620,13 @@ def alr_pin(crate, version="", path="", url="", commit="", branch="",
         else:
             raise ValueError("Specify either version, path or url")
 
-        with open(alr_manifest(), "at") as manifest:
-            manifest.writelines(["\n[[pins]]\n", pin_line + "\n"])
+        with open(alr_manifest(), "ab") as manifest:
+            manifest.write(f"\n[[pins]]\n{pin_line}\n".encode())
 
         # Make the lockfile "older" (otherwise timestamp is identical)
         alr_touch_manifest()
 
-        if update:
+        if _manual_update(update):
             return run_alr("pin")  # so the changes in the manifest are applied
 
     else:
@@ -479,38 +666,36 @@ def alr_with(dep="", path="", url="", commit="", branch="",
     if manual and dep == "":
         raise RuntimeError("Cannot manually add without explicit dependency")
 
-    separators = "/=^~<>*"
-
     # Fix the dependency if no version subset is in dep
-    if manual and not any([separator in dep for separator in separators]):
+    if manual and _DEP_SEPARATOR.search(dep) is None:
         dep += "*"
 
-    # Find the separator position
-    pos = len(dep) + 1
-    for separator in separators:
-        idx = dep.find(separator)
-        pos = idx if 0 < idx < pos else pos
+    # Find the separator position (past the first character)
+    match = _DEP_SEPARATOR.search(dep, 1)
+    pos = match.start() if match else len(dep) + 1
     if manual and pos > len(dep):
         raise RuntimeError(f"Should not happen, dep is {dep}")
 
     if manual:
+        crate, versions = dep[:pos], dep[pos:]
+
         if delete:
-            delete_array_entry_from_manifest("depends-on", dep, update=update)
+            delete_array_entry_from_manifest("depends-on", crate,
+                                             update=update)
         else:
-            with open(alr_manifest(), "at") as manifest:
-                lines = ["\n[[depends-on]]\n",
-                         f'{dep[:pos]} = "{dep[pos:]}"\n']
-                manifest.writelines(lines)
+            with open(alr_manifest(), "ab") as manifest:
+                manifest.write(
+                    f'\n[[depends-on]]\n{crate} = "{versions}"\n'.encode())
 
             if path != "" or url != "":
-                alr_pin(crate=f'{dep[:pos]}', path=path, url=url,
+                alr_pin(crate=crate, path=path, url=url,
                         commit=commit, branch=branch, manual=manual,
                         update=False)
 
             # Make the lockfile "older" (otherwise timestamp is identical)
             alr_touch_manifest()
 
-            if update:
+            if _manual_update(update, force):
                 return run_alr("with", force=force)
 
     else:
@@ -1,6 +1,7 @@
 import copy
 import os
 import shutil
+import stat
 import sys
 
 from drivers.alr import prepare_env, prepare_indexes, run_alr
@@ -105,7 +106,12 @@ class PythonScriptDriver(BaseDriver):
                 for d in dirs:
                     os.chmod(os.path.join(root, d), 0o777)
                 for f in files:
-                    os.chmod(os.path.join(root, f), 0o666)
+                    # Files may be hard links to fixtures, so leave alone
+                    # those already writable (only read-only ones are
+                    # copied instead of linked).
+                    file = os.path.join(root, f)
+                    if not os.stat(file).st_mode & stat.S_IWUSR:
+                        os.chmod(file, 0o666)
 
         base = self.test_env['working_dir']
         orig_name = ".orig"
@@ -17,6 +17,7 @@ from argparse import ArgumentTypeError
 
 import e3.testsuite
 import e3.testsuite.driver
+from drivers.alr import prepare_settings_template
 from drivers.driver.docker_wrapper import DockerWrapperDriver
 from drivers.driver.python_script import PythonScriptDriver
 from drivers.helpers import on_windows
@@ -70,6 +71,11 @@ class Testsuite(e3.testsuite.Testsuite):
             self.require_executable(exe)
         print()
 
+        # Prepare once the default alr settings that every test starts from
+        prepare_settings_template(
+            os.path.join(self.working_dir, 'alr-settings-template'),
+            os.environ)
+
     def _alr_path(self, alr_file):
         alr_path = os.path.abspath(alr_file)
         if not os.path.isfile(alr_path):
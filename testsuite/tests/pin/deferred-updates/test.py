@@ -0,0 +1,62 @@
+"""
+Verify that manual editions within `deferred_updates` update the solution only
+once, when leaving the outermost block
+"""
+
+import drivers.alr
+from drivers.alr import (alr_pin, alr_unpin, alr_with, deferred_updates,
+                         init_local_crate, run_alr)
+from drivers.asserts import assert_eq, assert_match
+
+# Record the alr commands run by the helpers, and whether they were forced
+commands = []
+run_alr_orig = drivers.alr.run_alr
+
+
+def recording_run_alr(*args, **kwargs):
+    commands.append((args, kwargs.get("force", False)))
+    return run_alr_orig(*args, **kwargs)
+
+
+init_local_crate()
+
+drivers.alr.run_alr = recording_run_alr
+
+# Several editions, with a nested block that must not update on its own
+with deferred_updates():
+    alr_with("libhello")
+    alr_pin("libhello", version="1.0.0")
+    with deferred_updates():
+        assert alr_with("hello") is None
+        alr_pin("hello", version="1.0.0")
+    assert_eq([], commands)
+
+# A single, unforced, `alr pin` is run on exit
+assert_eq([(("pin",), False)], commands)
+
+# All dependencies and pins are in effect
+p = run_alr("pin")
+assert_match(r".*\bhello 1.0.0\n", p.out)
+assert_match(r".*\blibhello 1.0.0\n", p.out)
+p = run_alr("show", "--solve")
+assert_match(r".*Dependencies \(solution\):.*\bhello=1.0.0", p.out)
+assert_match(r".*Dependencies \(solution\):.*\blibhello=1.0.0", p.out)
+
+# The update on exit is forced if any deferred edition asked for it
+commands.clear()
+with deferred_updates():
+    alr_with("hello", delete=True)
+    alr_with("hello", force=True)
+assert_eq([(("pin",), True)], commands)
+
+# Editions without update run nothing on exit, but leave the lockfile outdated
+# so the next command synchronizes the workspace.
+commands.clear()
+with deferred_updates():
+    alr_unpin("hello", update=False)
+assert_eq([], commands)
+
+p = run_alr("with", quiet=False)
+assert_match(".*Synchronizing workspace", p.out)
+
+print('SUCCESS')